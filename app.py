@@ -2,12 +2,10 @@
 import streamlit as st
 import os
 import sys
-import yaml
-import time
+import collections
 from datetime import datetime
-import threading
-from queue import Queue
-import traceback
+import multiprocessing
+from queue import Empty
 
 # --- Add project root to sys.path ---
 project_root = os.path.dirname(os.path.abspath(__file__))
@@ -17,16 +15,39 @@ src_path = os.path.join(project_root, "src")
 if src_path not in sys.path:
     sys.path.insert(0, src_path)
 
-# --- Import backend modules ---
-try:
-    from src.config_loader import load_config
-    from src.a1111_client import A1111Client
-    from src.generator import generate_parameter_combinations
-    from src.dataset_builder import DatasetBuilder
+# --- Backend modules ---
+# Imported lazily where they are used: the worker only when a generation starts
+# (its dependencies load in the worker process), the manager only on its page.
+@st.cache_resource(show_spinner=False)
+def _get_manager(base_dir):
+    """Returns the DatasetManager for `base_dir`, created once per server process."""
     from src.dataset_manager import DatasetManager
-except ImportError as e:
-    st.error(f"Error importing backend modules: {e}. Ensure 'src' directory is accessible.")
-    st.stop()
+    return DatasetManager(base_dir)
+
+# Listing and inspecting datasets scans the disk, so results are cached briefly
+# and invalidated explicitly after archive/export/delete.
+@st.cache_data(ttl=5, show_spinner=False)
+def _list_datasets(base_dir, include_archived):
+    return _get_manager(base_dir).list_datasets(include_archived=include_archived)
+
+@st.cache_data(ttl=5, show_spinner=False)
+def _get_dataset_info(base_dir, dataset_name):
+    return _get_manager(base_dir).get_dataset_info(dataset_name)
+
+def _clear_dataset_caches():
+    _list_datasets.clear()
+    _get_dataset_info.clear()
+
+# The worker runs in its own process so response decoding and disk writes don't
+# compete with the Streamlit script for the GIL. 'spawn' behaves the same on all platforms.
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+# Directory listed on the dataset management page
+DATASETS_DIR = "./output_datasets"
+# Number of most recent images kept for the preview grid
+PREVIEW_HISTORY = 16
+# Number of most recent log lines kept in the session state
+LOG_HISTORY = 500
 
 # --- App State Initialization ---
 if 'is_running' not in st.session_state:
@@ -34,88 +55,91 @@ if 'is_running' not in st.session_state:
 if 'progress' not in st.session_state:
     st.session_state.progress = 0.0
 if 'log_messages' not in st.session_state:
-    st.session_state.log_messages = []
+    st.session_state.log_messages = collections.deque(maxlen=LOG_HISTORY)
 if 'generated_images_data' not in st.session_state:
-    st.session_state.generated_images_data = []
+    st.session_state.generated_images_data = collections.deque(maxlen=PREVIEW_HISTORY)
 if 'status_message' not in st.session_state:
     st.session_state.status_message = "Idle."
 if 'total_combinations' not in st.session_state:
     st.session_state.total_combinations = 0
-if 'generation_thread' not in st.session_state:
-    st.session_state.generation_thread = None
+if 'generation_process' not in st.session_state:
+    st.session_state.generation_process = None
 if 'error_message' not in st.session_state:
     st.session_state.error_message = None
 if 'progress_queue' not in st.session_state:
-    st.session_state.progress_queue = Queue()
-
-# --- Worker Function ---
-def generation_worker(api_url_w, dataset_name_w, output_base_dir_w,
-                     base_params_w, variations_w, queue):
-    """Background worker for image generation process."""
-    try:
-        queue.put({"log": "Worker thread started..."})
+    st.session_state.progress_queue = _MP_CONTEXT.Queue()
+if 'preview_dir' not in st.session_state:
+    st.session_state.preview_dir = None # Thumbnails of the last run, removed when the next one starts
 
+# --- Background Task Handling ---
+def drain_progress_queue():
+    """Applies all pending worker messages to the session state."""
+    while True:
         try:
-            client = A1111Client(api_url_w)
-            builder = DatasetBuilder(dataset_name_w, output_base_dir_w)
-            queue.put({"log": "Backend initialized."})
-        except Exception as e:
-            raise RuntimeError(f"Failed to initialize backend: {e}")
-
-        queue.put({"status": "Calculating parameter combinations..."})
-        param_combinations = list(generate_parameter_combinations(base_params_w, variations_w))
-        total_combinations = len(param_combinations)
-        st.session_state.total_combinations = total_combinations
-        queue.put({"status": f"Found {total_combinations} combinations."})
-
-        if total_combinations == 0:
-            raise ValueError("No parameter combinations generated. Check variations.")
-
-        generated_count = 0
-        failed_count = 0
-
-        for i, params in enumerate(param_combinations):
-            current_job_text = f"Generating image {i+1}/{total_combinations}..."
-            progress = (i + 1) / total_combinations
-            queue.put({
-                "status": current_job_text,
-                "progress": progress,
-                "log": f"INFO: {current_job_text}\nDEBUG: {params}"
-            })
+            msg = st.session_state.progress_queue.get_nowait()
+        except Empty:
+            break
+        if "log" in msg:
+            # One entry per line, so multi-line tracebacks count towards the cap
+            st.session_state.log_messages.extend(str(msg["log"]).splitlines())
+        if "status" in msg:
+            st.session_state.status_message = msg["status"]
+        if "progress" in msg:
+            st.session_state.progress = msg["progress"]
+        if "total" in msg:
+            st.session_state.total_combinations = msg["total"]
+        if "image" in msg:
+            st.session_state.generated_images_data.append(msg["image"])
+        if "preview_dir" in msg:
+            st.session_state.preview_dir = msg["preview_dir"]
+        if "error" in msg:
+            st.session_state.error_message = msg["error"]
+            st.session_state.is_running = False
+        if msg.get("done", False):
+            st.session_state.is_running = False
+            st.session_state.status_message = msg.get("status", "Finished.")
+            st.session_state.progress = msg.get("progress", 1.0)
 
-            try:
-                image_bytes, generation_info = client.generate_image(params)
-
-                if image_bytes and generation_info:
-                    metadata = generation_info.copy()
-                    metadata['request_parameters'] = params
-                    builder.add_image(image_bytes, metadata)
-                    generated_count += 1
-                    caption = f"Image {i+1}: {metadata.get('filename', 'N/A')}"
-                    queue.put({
-                        "log": f"SUCCESS: Image {i+1} saved.",
-                        "image": (caption, image_bytes)
-                    })
-                else:
-                    failed_count += 1
-                    queue.put({"log": f"ERROR: Image {i+1} generation failed."})
+    if (st.session_state.is_running and st.session_state.generation_process
+            and not st.session_state.generation_process.is_alive()
+            and st.session_state.progress_queue.empty()):
+        st.session_state.is_running = False
+        st.session_state.error_message = (st.session_state.error_message or 
+                                        "Worker process stopped unexpectedly.")
+        st.session_state.status_message = "Error: Worker process stopped."
 
-            except Exception as e:
-                failed_count += 1
-                error_trace = traceback.format_exc()
-                queue.put({"log": f"CRITICAL: Error on image {i+1}: {e}\n{error_trace}"})
+# st.fragment replaced st.experimental_fragment in Streamlit 1.37
+_fragment = getattr(st, "fragment", None) or st.experimental_fragment
 
-        final_status = f"Finished. Generated: {generated_count}, Failed: {failed_count}."
-        metadata_path = builder.finalize_dataset()
-        if metadata_path:
-            final_status += f"\nDataset saved. Metadata: {metadata_path}"
+# While a generation is running only this fragment is re-run every 0.5 s,
+# instead of the whole script.
+@_fragment(run_every=0.5 if st.session_state.is_running else None)
+def progress_section():
+    """Status, progress, logs and previews of the current generation."""
+    was_running = st.session_state.is_running
+    drain_progress_queue()
 
-        queue.put({"status": final_status, "progress": 1.0, "done": True})
+    st.info(st.session_state.status_message)
+    st.progress(st.session_state.progress)
 
-    except Exception as e:
-        error_trace = traceback.format_exc()
-        queue.put({"status": f"Worker Error: {e}", "error": str(e), 
-                  "log": error_trace, "done": True})
+    if st.session_state.error_message:
+        st.error(st.session_state.error_message)
+
+    with st.expander("Logs", expanded=False):
+        st.code('\n'.join(list(st.session_state.log_messages)[-15:]))
+
+    if st.session_state.generated_images_data:
+        st.subheader("Generated Images Preview")
+        cols = st.columns(4)
+        for idx, (caption, preview_path) in enumerate(st.session_state.generated_images_data):
+            try:
+                cols[idx % 4].image(preview_path, caption=caption, width=200)
+            except Exception as e:
+                cols[idx % 4].warning(f"Could not display image {idx+1}: {e}")
+
+    if was_running and not st.session_state.is_running:
+        # Full rerun so the sidebar inputs and start button are enabled again
+        st.rerun()
 
 # --- App Configuration ---
 st.set_page_config(page_title="GenDatasetImages", page_icon="🖼️", layout="wide")
@@ -188,32 +212,19 @@ if page == "Generate":
     st.markdown("---")
     st.header("Progress & Results")
 
-    status_placeholder = st.empty()
-    status_placeholder.info(st.session_state.status_message)
-    progress_bar = st.progress(st.session_state.progress)
-
-    if st.session_state.error_message:
-        st.error(st.session_state.error_message)
-
-    with st.expander("Logs", expanded=False):
-        st.code('\n'.join(map(str, st.session_state.log_messages[-15:])))
-
-    if st.session_state.generated_images_data:
-        st.subheader("Generated Images Preview")
-        cols = st.columns(4)
-        for idx, (caption, img_bytes) in enumerate(st.session_state.generated_images_data):
-            try:
-                cols[idx % 4].image(img_bytes, caption=caption, width=200)
-            except Exception as e:
-                cols[idx % 4].warning(f"Could not display image {idx+1}: {e}")
+    progress_section()
 
 # --- Dataset Management Page ---
 else:
     st.title("📁 Dataset Management")
     st.markdown("Manage, archive, and export your generated datasets.")
     
-    manager = DatasetManager("./output_datasets")
-    datasets = manager.list_datasets(include_archived=True)
+    try:
+        manager = _get_manager(DATASETS_DIR)
+    except ImportError as e:
+        st.error(f"Error importing backend modules: {e}. Ensure 'src' directory is accessible.")
+        st.stop()
+    datasets = _list_datasets(DATASETS_DIR, True)
     
     if not datasets:
         st.info("No datasets found. Generate some images first!")
@@ -231,7 +242,8 @@ else:
         if selected_dataset:
             with col2:
                 st.subheader("Dataset Details")
-                info = manager.get_dataset_info(selected_dataset.split('_')[0])
+                dataset_id = selected_dataset.split('_')[0]
+                info = _get_dataset_info(DATASETS_DIR, dataset_id)
                 
                 st.write(f"**Status:** {info['status'].title()}")
                 st.write(f"**Created:** {info['created']}")
@@ -244,9 +256,10 @@ else:
                     if info['status'] == 'active':
                         if st.button("📦 Archive"):
                             try:
-                                manager.archive_dataset(selected_dataset.split('_')[0])
+                                manager.archive_dataset(dataset_id)
+                                _clear_dataset_caches()
                                 st.success("Dataset archived!")
-                                st.experimental_rerun()
+                                st.rerun()
                             except Exception as e:
                                 st.error(f"Error archiving dataset: {e}")
                 
@@ -254,7 +267,8 @@ else:
                     if st.button("⬇️ Export ZIP"):
                         try:
                             with st.spinner("Creating ZIP file..."):
-                                zip_path = manager.export_dataset(selected_dataset.split('_')[0])
+                                zip_path = manager.export_dataset(dataset_id)
+                            _clear_dataset_caches()
                             with open(zip_path, "rb") as f:
                                 st.download_button(
                                     "📥 Download ZIP",
@@ -269,9 +283,10 @@ else:
                     if st.button("🗑️ Delete", type="secondary"):
                         if st.checkbox("Confirm deletion?"):
                             try:
-                                manager.delete_dataset(selected_dataset.split('_')[0])
+                                manager.delete_dataset(dataset_id)
+                                _clear_dataset_caches()
                                 st.success("Dataset deleted!")
-                                st.experimental_rerun()
+                                st.rerun()
                             except Exception as e:
                                 st.error(f"Error deleting dataset: {e}")
                 
@@ -279,49 +294,12 @@ else:
                     with st.expander("Sample Metadata"):
                         st.json(info['metadata_sample'][0])
 
-# --- Background Task Handling ---
-if st.session_state.is_running or not st.session_state.progress_queue.empty():
-    while not st.session_state.progress_queue.empty():
-        msg = st.session_state.progress_queue.get()
-        if "log" in msg:
-            st.session_state.log_messages.append(msg["log"])
-        if "status" in msg:
-            st.session_state.status_message = msg["status"]
-        if "progress" in msg:
-            st.session_state.progress = msg["progress"]
-        if "image" in msg:
-            st.session_state.generated_images_data.append(msg["image"])
-        if "error" in msg:
-            st.session_state.error_message = msg["error"]
-            st.session_state.is_running = False
-        if msg.get("done", False):
-            st.session_state.is_running = False
-            st.session_state.status_message = msg.get("status", "Finished.")
-            st.session_state.progress = msg.get("progress", 1.0)
-
-    status_placeholder.info(st.session_state.status_message)
-    progress_bar.progress(st.session_state.progress)
-    if st.session_state.error_message:
-        st.error(st.session_state.error_message)
-
-    if (st.session_state.is_running and st.session_state.generation_thread 
-            and not st.session_state.generation_thread.is_alive()):
-        st.session_state.is_running = False
-        st.session_state.error_message = (st.session_state.error_message or 
-                                        "Thread stopped unexpectedly.")
-        st.session_state.status_message = "Error: Thread stopped."
-        st.error(st.session_state.error_message)
-
-    if st.session_state.is_running:
-        time.sleep(0.5)
-        st.experimental_rerun()
-
 # --- Start Generation Logic ---
 if start_button and not st.session_state.is_running:
     st.session_state.is_running = True
     st.session_state.progress = 0.0
-    st.session_state.log_messages = ["Initiating..."]
-    st.session_state.generated_images_data = []
+    st.session_state.log_messages = collections.deque(["Initiating..."], maxlen=LOG_HISTORY)
+    st.session_state.generated_images_data = collections.deque(maxlen=PREVIEW_HISTORY)
     st.session_state.status_message = "Parsing inputs..."
     st.session_state.error_message = None
     st.session_state.total_combinations = 0
@@ -361,15 +339,17 @@ if start_button and not st.session_state.is_running:
         if not variations and not base_params.get('prompt'):
             raise ValueError("Please provide at least a base prompt or variations.")
 
-        st.session_state.generation_thread = threading.Thread(
-            target=generation_worker,
+        from src.worker import run_generation_worker
+
+        st.session_state.generation_process = _MP_CONTEXT.Process(
+            target=run_generation_worker,
             args=(api_url, dataset_name, output_base_dir,
                   base_params, variations,
-                  st.session_state.progress_queue),
+                  st.session_state.progress_queue, st.session_state.preview_dir),
             daemon=True
         )
-        st.session_state.generation_thread.start()
-        st.experimental_rerun()
+        st.session_state.generation_process.start()
+        st.rerun()
 
     except Exception as e:
         st.session_state.is_running = False
@@ -1,32 +1,89 @@
 # Module for interacting with the Automatic1111 Stable Diffusion Web UI API.
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 import base64
 import json
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple
+
+# Optional accelerated decoders; the standard library versions are used if missing.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so error handling is shared.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import pybase64 as _base64
+except ImportError:
+    _base64 = base64
+# Optional incremental JSON parser used to stream large responses.
+try:
+    import ijson
+except ImportError:
+    ijson = None
+# Only the async methods (used by the web app) need aiohttp; the CLI works without it.
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def _json_loads(data):
+    """Parses JSON from bytes or str, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Per-image fields that A1111 reports as parallel lists for a batched request.
+_PER_IMAGE_INFO_FIELDS = (
+    ('prompt', 'all_prompts'),
+    ('negative_prompt', 'all_negative_prompts'),
+    ('seed', 'all_seeds'),
+    ('subseed', 'all_subseeds'),
+)
 
 class A1111Client:
     """
     A client to interact with the Automatic1111 Stable Diffusion Web UI API.
     """
-    def __init__(self, api_url: str):
+    def __init__(self, api_url: str, pool_size: int = 8):
         """
         Initializes the A1111Client.
 
         Args:
             api_url: The base URL of the A1111 API (e.g., "http://127.0.0.1:7860").
                      Should not end with a slash.
+            pool_size: Keep-alive connections kept per host. Should be at least the
+                       number of threads sending requests concurrently, otherwise
+                       extra connections are opened and discarded.
         """
         if api_url.endswith('/'):
             api_url = api_url[:-1] # Remove trailing slash if present
         self.base_url = api_url
         self.txt2img_url = f"{self.base_url}/sdapi/v1/txt2img"
+
+        # One keep-alive session for all requests instead of a new connection per image.
+        # urllib3 only retries idempotent methods on status codes, so a POST that reached
+        # the server is never re-sent; connection failures are retried for all methods.
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504))
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
         self._check_api_availability()
 
     def _check_api_availability(self):
         """Checks if the A1111 API is reachable."""
         try:
             # Use a simple endpoint like /sdapi/v1/progress to check connection
-            response = requests.get(f"{self.base_url}/sdapi/v1/progress", timeout=5)
+            response = self._session.get(f"{self.base_url}/sdapi/v1/progress", timeout=5)
             response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
             print(f"Successfully connected to A1111 API at {self.base_url}")
         except requests.exceptions.ConnectionError:
@@ -36,34 +93,23 @@ class A1111Client:
         except requests.exceptions.RequestException as e:
             raise RuntimeError(f"Error checking A1111 API status: {e}")
 
-    def generate_image(self, payload: Dict[str, Any]) -> Tuple[Optional[bytes], Optional[Dict[str, Any]]]:
+    def _post_txt2img(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
-        Sends a request to the txt2img endpoint to generate an image.
-
-        Args:
-            payload: A dictionary containing the parameters for the txt2img API call.
-                     See A1111 API documentation for details.
-                     Example keys: 'prompt', 'negative_prompt', 'seed', 'steps', 'cfg_scale', etc.
+        Posts a payload to the txt2img endpoint and returns the parsed JSON response.
 
         Returns:
-            A tuple containing:
-            - The generated image as bytes (if successful, otherwise None).
-            - The 'info' dictionary from the API response containing generation metadata
-              (if successful, otherwise None). Returns None if the API response format is unexpected.
-
-        Raises:
-            requests.exceptions.RequestException: If the API request fails.
-            ValueError: If the API response is not as expected.
+            The decoded response dictionary, or None if the request or decoding failed.
         """
         print(f"Sending generation request to {self.txt2img_url}...")
         # print(f"Payload: {json.dumps(payload, indent=2)}") # Uncomment for debugging
 
         try:
-            response = requests.post(url=self.txt2img_url, json=payload, timeout=300) # 5 min timeout
+            response = self._session.post(url=self.txt2img_url, json=payload, timeout=300, # 5 min timeout
+                                          stream=ijson is not None)
             response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
         except requests.exceptions.Timeout:
             print("Error: Request to A1111 API timed out.")
-            return None, None
+            return None
         except requests.exceptions.RequestException as e:
             print(f"Error during A1111 API request: {e}")
             # Attempt to get more details from the response if available
@@ -72,37 +118,262 @@ class A1111Client:
                 print(f"API Error Details: {json.dumps(error_details, indent=2)}")
             except (AttributeError, json.JSONDecodeError):
                 print("Could not decode error details from API response.")
-            return None, None
+            return None
+
+        if ijson is not None:
+            try:
+                return self._parse_streamed_response(response)
+            except ijson.JSONError as e:
+                print(f"Error processing A1111 API response: {e}")
+                return None
+            except ValueError as e: # Includes binascii.Error for invalid base64
+                print(f"Error decoding image data in A1111 API response: {e}")
+                return None
+            except (Urllib3HTTPError, requests.exceptions.RequestException) as e:
+                # The body is read lazily, so a dropped or truncated connection surfaces here
+                print(f"Error reading A1111 API response: {e}")
+                return None
+            finally:
+                response.close()
 
         try:
-            r = response.json()
-            if 'images' not in r or not isinstance(r['images'], list) or len(r['images']) == 0:
-                print("Error: 'images' field missing or invalid in API response.")
-                print(f"Full response: {json.dumps(r, indent=2)}")
-                return None, None
+            return _json_loads(response.content)
+        except json.JSONDecodeError as e:
+            print(f"Error processing A1111 API response: {e}")
+            print(f"Full response: {response.text}") # Print raw response text for debugging
+            return None
 
-            # Decode the first image (assuming batch size 1 for now)
-            image_data = base64.b64decode(r['images'][0])
+    @staticmethod
+    def _parse_streamed_response(response: requests.Response) -> Dict[str, Any]:
+        """
+        Parses a streamed txt2img response incrementally with ijson.
 
-            # Extract generation info (metadata)
-            info_str = r.get('info', '{}') # Get info string, default to empty JSON string
-            try:
-                info_dict = json.loads(info_str)
-            except json.JSONDecodeError:
-                print("Warning: Could not parse 'info' JSON string from API response.")
-                print(f"Info string received: {info_str}")
-                info_dict = {} # Return empty dict if parsing fails
+        Each image is base64-decoded as soon as its string has been read, so the encoded
+        and decoded copies of all images are never in memory together. The 'parameters'
+        echo of the request is skipped without building any objects.
+
+        Returns:
+            A response dictionary whose 'images' already hold the decoded bytes.
+        """
+        response.raw.decode_content = True # Let urllib3 undo any gzip transfer encoding
+        r: Dict[str, Any] = {'images': [], 'info': '{}'}
+        for prefix, event, value in ijson.parse(response.raw):
+            if event != 'string':
+                continue
+            if prefix == 'images.item':
+                r['images'].append(_base64.b64decode(value, validate=False))
+            elif prefix == 'info':
+                r['info'] = value
+        return r
+
+    def _decode_response(self, r: Dict[str, Any], expected: int) -> Tuple[List[bytes], Dict[str, Any]]:
+        """
+        Decodes the images and the 'info' dictionary from a txt2img response.
+
+        Args:
+            r: The parsed JSON response. Images may already be decoded to bytes.
+            expected: The number of images requested (batch_size). Any extra leading
+                      images (e.g. the grid A1111 returns for batches) are dropped.
+
+        Returns:
+            A tuple of (list of image bytes, info dictionary).
 
-            print("Image generated successfully.")
-            return image_data, info_dict
+        Raises:
+            ValueError: If the 'images' field is missing or holds too few images.
+        """
+        if 'images' not in r or not isinstance(r['images'], list) or len(r['images']) < expected:
+            print(f"Full response: {json.dumps(r, indent=2, default=repr)}")
+            raise ValueError("'images' field missing or invalid in API response.")
+
+        # Extract generation info (metadata)
+        info_str = r.get('info', '{}') # Get info string, default to empty JSON string
+        try:
+            info_dict = _json_loads(info_str)
+        except json.JSONDecodeError:
+            print("Warning: Could not parse 'info' JSON string from API response.")
+            print(f"Info string received: {info_str}")
+            info_dict = {} # Use empty dict if parsing fails
+
+        first = info_dict.get('index_of_first_image', len(r['images']) - expected)
+        images = [img if isinstance(img, bytes) else _base64.b64decode(img, validate=False)
+                  for img in r['images'][first:first + expected]]
+        return images, info_dict
+
+    @staticmethod
+    def _split_info(info: Dict[str, Any], index: int) -> Dict[str, Any]:
+        """
+        Builds the metadata for one image of a batch from the shared 'info' dictionary,
+        so that it looks like the info of a single-image request.
+        """
+        image_info = dict(info)
+        for field, list_field in _PER_IMAGE_INFO_FIELDS:
+            values = info.get(list_field)
+            if isinstance(values, list) and index < len(values):
+                image_info[field] = values[index]
+                image_info[list_field] = [values[index]]
+        infotexts = info.get('infotexts')
+        if isinstance(infotexts, list) and index < len(infotexts):
+            image_info['infotexts'] = [infotexts[index]]
+        return image_info
+
+    def _unpack_batch(self, r: Dict[str, Any], count: int) -> List[Tuple[Optional[bytes], Optional[Dict[str, Any]]]]:
+        """
+        Splits a txt2img response for `count` images into per-image (bytes, info) tuples.
+        Every info dict is a new object that callers may modify in place.
+        All tuples are (None, None) if the response could not be processed.
+        """
+        try:
+            images, info_dict = self._decode_response(r, count)
+            if count == 1:
+                print("Image generated successfully.")
+                return [(images[0], info_dict)]
+            print(f"Batch of {count} images generated successfully.")
+            return [(images[pos], self._split_info(info_dict, pos)) for pos in range(count)]
 
-        except (json.JSONDecodeError, KeyError, IndexError, base64.binascii.Error) as e:
+        except (ValueError, KeyError, IndexError, base64.binascii.Error) as e:
             print(f"Error processing A1111 API response: {e}")
-            print(f"Full response: {response.text}") # Print raw response text for debugging
-            return None, None
         except Exception as e:
             print(f"An unexpected error occurred while processing the response: {e}")
+        return [(None, None)] * count
+
+    def generate_image(self, payload: Dict[str, Any]) -> Tuple[Optional[bytes], Optional[Dict[str, Any]]]:
+        """
+        Sends a request to the txt2img endpoint to generate an image.
+
+        Args:
+            payload: A dictionary containing the parameters for the txt2img API call.
+                     See A1111 API documentation for details.
+                     Example keys: 'prompt', 'negative_prompt', 'seed', 'steps', 'cfg_scale', etc.
+
+        Returns:
+            A tuple containing:
+            - The generated image as bytes (if successful, otherwise None).
+            - The 'info' dictionary from the API response containing generation metadata
+              (if successful, otherwise None). Returns None if the API response format is unexpected.
+
+        Raises:
+            requests.exceptions.RequestException: If the API request fails.
+            ValueError: If the API response is not as expected.
+        """
+        r = self._post_txt2img(payload)
+        if r is None:
             return None, None
+        return self._unpack_batch(r, 1)[0]
+
+    @staticmethod
+    def _group_batches(payloads: List[Dict[str, Any]]) -> List[List[int]]:
+        """
+        Groups payload indices into runs that a single txt2img request can reproduce.
+
+        The API takes one prompt and one seed per request and gives the i-th image of a
+        batch the seed `seed + i`, so payloads are grouped when they are identical apart
+        from 'seed' and their seeds are either consecutive or all random (-1).
+        """
+        groups: List[List[int]] = []
+        open_groups: Dict[str, List[int]] = {}
+        for idx, payload in enumerate(payloads):
+            if payload.get('batch_size', 1) != 1 or payload.get('n_iter', 1) != 1:
+                groups.append([idx]) # Already a batch of its own
+                continue
+            key = json.dumps({k: v for k, v in payload.items() if k != 'seed'},
+                             sort_keys=True, default=str)
+            seed = payload.get('seed', -1)
+            group = open_groups.get(key)
+            if group is not None:
+                last_seed = payloads[group[-1]].get('seed', -1)
+                if (seed == -1 and last_seed == -1) or (
+                        isinstance(seed, int) and isinstance(last_seed, int)
+                        and last_seed != -1 and seed == last_seed + 1):
+                    group.append(idx)
+                    continue
+            group = [idx]
+            open_groups[key] = group
+            groups.append(group)
+        return groups
+
+    @staticmethod
+    def _batch_payload(payload: Dict[str, Any], count: int) -> Dict[str, Any]:
+        """Returns the payload for a batched request of `count` images starting at `payload`."""
+        if count == 1:
+            return payload
+        batch_payload = dict(payload)
+        batch_payload['batch_size'] = count
+        batch_payload['do_not_save_grid'] = True
+        return batch_payload
+
+    def generate_images_batch(self, payloads: List[Dict[str, Any]]) -> List[Tuple[Optional[bytes], Optional[Dict[str, Any]]]]:
+        """
+        Generates images for several payloads, sending compatible payloads as one
+        batched txt2img request so the server runs them in a single GPU batch.
+
+        Args:
+            payloads: A list of txt2img payloads (see generate_image).
+
+        Returns:
+            A list with one (image bytes, info dict) tuple per payload, in input order.
+            Both items are None for payloads whose request failed.
+        """
+        results: List[Tuple[Optional[bytes], Optional[Dict[str, Any]]]] = [(None, None)] * len(payloads)
+
+        for group in self._group_batches(payloads):
+            r = self._post_txt2img(self._batch_payload(payloads[group[0]], len(group)))
+            if r is None:
+                continue
+            for idx, result in zip(group, self._unpack_batch(r, len(group))):
+                results[idx] = result
+
+        return results
+
+    async def _apost_txt2img(self, session: "aiohttp.ClientSession", payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Async counterpart of _post_txt2img using an aiohttp session."""
+        print(f"Sending generation request to {self.txt2img_url}...")
+
+        try:
+            async with session.post(self.txt2img_url, json=payload,
+                                    timeout=aiohttp.ClientTimeout(total=300)) as response: # 5 min timeout
+                body = await response.read()
+                if response.status >= 400:
+                    print(f"Error during A1111 API request: HTTP {response.status}")
+                    try:
+                        print(f"API Error Details: {json.dumps(json.loads(body), indent=2)}")
+                    except (ValueError, UnicodeDecodeError):
+                        print("Could not decode error details from API response.")
+                    return None
+        except asyncio.TimeoutError:
+            print("Error: Request to A1111 API timed out.")
+            return None
+        except aiohttp.ClientError as e:
+            print(f"Error during A1111 API request: {e}")
+            return None
+
+        try:
+            return _json_loads(body)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            print(f"Error processing A1111 API response: {e}")
+            print(f"Full response: {body[:1000]!r}") # Print start of raw response for debugging
+            return None
+
+    async def agenerate_images_batch(self, payloads: List[Dict[str, Any]], session: "aiohttp.ClientSession") -> List[Tuple[Optional[bytes], Optional[Dict[str, Any]]]]:
+        """
+        Async version of generate_images_batch. The batched requests for one call are
+        sent concurrently on the given session; several calls can also be awaited
+        concurrently, and A1111 queues the overlapping requests on its side.
+        Requires aiohttp.
+        """
+        results: List[Tuple[Optional[bytes], Optional[Dict[str, Any]]]] = [(None, None)] * len(payloads)
+        groups = self._group_batches(payloads)
+
+        responses = await asyncio.gather(*(
+            self._apost_txt2img(session, self._batch_payload(payloads[group[0]], len(group)))
+            for group in groups
+        ))
+        for group, r in zip(groups, responses):
+            if r is None:
+                continue
+            for idx, result in zip(group, self._unpack_batch(r, len(group))):
+                results[idx] = result
+
+        return results
 
 
 if __name__ == '__main__':
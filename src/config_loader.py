@@ -1,12 +1,24 @@
 # Module for loading and validating configuration files (e.g., YAML).
 import yaml
 import os
+import copy
+import functools
 from typing import Dict, Any, List
 
+# Keys every configuration file must define
+_REQUIRED_KEYS = frozenset({'api_url', 'dataset_name', 'output_base_dir', 'base_parameters', 'parameter_variations'})
+
+# Use the libyaml C loader when PyYAML was built with it
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 def load_config(config_path: str) -> Dict[str, Any]:
     """
     Loads the configuration from a YAML file.
 
+    Parsed configurations are cached per file path and modification time, so
+    repeated calls only re-read the file after it has been edited.
+
     Args:
         config_path: Path to the YAML configuration file.
 
@@ -21,9 +33,17 @@ def load_config(config_path: str) -> Dict[str, Any]:
     if not os.path.exists(config_path):
         raise FileNotFoundError(f"Configuration file not found: {config_path}")
 
+    config = _load_config_cached(os.path.abspath(config_path), os.path.getmtime(config_path))
+    # Hand out a copy so callers can't mutate the cached configuration
+    return copy.deepcopy(config)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_config_cached(config_path: str, mtime: float) -> Dict[str, Any]:
+    """Parses and validates a configuration file. `mtime` is only part of the cache key."""
     try:
         with open(config_path, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=_YAML_LOADER)
     except yaml.YAMLError as e:
         raise yaml.YAMLError(f"Error parsing YAML file {config_path}: {e}")
     except Exception as e:
@@ -33,10 +53,11 @@ def load_config(config_path: str) -> Dict[str, Any]:
         raise ValueError(f"Configuration file {config_path} is empty or invalid.")
 
     # Basic validation (can be expanded)
-    required_keys = ['api_url', 'dataset_name', 'output_base_dir', 'base_parameters', 'parameter_variations']
-    for key in required_keys:
-        if key not in config:
-            raise ValueError(f"Missing required key in configuration: '{key}'")
+    if not isinstance(config, dict):
+        raise ValueError(f"Configuration file {config_path} must contain a mapping at the top level.")
+    missing = _REQUIRED_KEYS - config.keys()
+    if missing:
+        raise ValueError(f"Missing required key(s) in configuration: {', '.join(sorted(missing))}")
 
     # Validate parameter_variations structure (basic check)
     if not isinstance(config.get('parameter_variations'), dict):
@@ -45,6 +66,12 @@ def load_config(config_path: str) -> Dict[str, Any]:
         if not isinstance(values, list):
             raise ValueError(f"Values for '{param}' in 'parameter_variations' must be a list.")
 
+    # Optional number of concurrent generation requests
+    concurrency = config.get('concurrency')
+    if concurrency is not None and (not isinstance(concurrency, int) or isinstance(concurrency, bool)
+                                    or concurrency < 1):
+        raise ValueError("'concurrency' must be a positive integer.")
+
     print(f"Configuration loaded successfully from: {config_path}")
     return config
 
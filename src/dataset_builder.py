@@ -1,11 +1,297 @@
 """Module for building dataset structure and saving metadata, using DatasetManager."""
 import os
+import re
 import json
 import hashlib
-from typing import Dict, Any, Optional
+import queue
+import shutil
+from typing import Dict, Any, List, Optional, Tuple
 import threading
+import weakref
+from concurrent.futures import Future
 from .dataset_manager import DatasetManager
 
+# orjson serializes metadata straight to UTF-8 bytes; json is used if it is missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+# POSIX file locks serialize shard merges from runs that share a dataset directory
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# BLAKE3 (SIMD, multi-lane) is preferred for the filename hash when installed
+try:
+    from blake3 import blake3 as _blake3
+except ImportError:
+    _blake3 = None
+
+# Bytes taken from each end of an image for the filename hash
+HASH_SAMPLE_BYTES = 4096
+
+# Most queued writes handled per writer pass; their metadata lines go out in one
+# writev() call, so keep this below the usual IOV_MAX of 1024
+WRITE_BATCH_SIZE = 64
+
+# Characters dropped from the prompt part of filenames. \W is the complement of
+# str.isalnum() plus "_", so non-ASCII prompts keep their letters.
+_CLEAN_RE = re.compile(r'\W+')
+
+# Shared stand-in for missing request parameters; only ever read
+_EMPTY_DICT: Dict[str, Any] = {}
+
+# Images waiting for the background writers; add_image blocks once this many are queued
+WRITE_QUEUE_SIZE = 32
+# Background writer threads. Each appends to its own metadata shard, so they share no lock.
+WRITER_THREADS = 2
+# Per-thread metadata files (metadata.part-<pid>-<thread id>.jsonl), merged into metadata.jsonl on close
+SHARD_PREFIX = "metadata.part-"
+
+
+def _short_hash(*parts: bytes) -> str:
+    """Returns an 8 hex character digest of the parts, using BLAKE3 if available and SHA-1 otherwise."""
+    hasher = _blake3() if _blake3 is not None else hashlib.sha1()
+    for part in parts:
+        hasher.update(part)
+    if _blake3 is not None:
+        return hasher.hexdigest(length=4)
+    return hasher.hexdigest()[:8]
+
+
+def _json_line(record: Dict[str, Any]) -> bytes:
+    """Serializes a record as one UTF-8 JSON Lines entry, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+def _write_all(fd: int, buffers: List[bytes]):
+    """Writes all buffers to fd, using a single writev() where the platform has it."""
+    if hasattr(os, 'writev'):
+        written = os.writev(fd, buffers)
+        total = sum(len(b) for b in buffers)
+        if written == total:
+            return
+        data = memoryview(b''.join(buffers))[written:]  # Rare partial write
+    else:
+        data = memoryview(b''.join(buffers))
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _append_file(out_fd: int, path: str):
+    """Appends the contents of path to out_fd, with zero-copy sendfile() where possible."""
+    with open(path, "rb") as src:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        if hasattr(os, 'sendfile'):
+            try:
+                while offset < size:
+                    sent = os.sendfile(out_fd, src.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return
+            except OSError:
+                src.seek(offset)  # Not supported for these files; copy the rest
+        with open(out_fd, "wb", closefd=False) as dst:
+            shutil.copyfileobj(src, dst)
+
+
+def _process_alive(pid: int) -> bool:
+    """Whether a process with this pid exists. Assumed alive where that can't be checked safely."""
+    if os.name == 'nt':
+        return True  # os.kill() would terminate the process on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Exists, owned by another user
+    return True
+
+
+def _write_file(path: str, data: bytes):
+    """
+    Writes data to a new file through a raw fd, skipping the Python file object.
+    Space is reserved up front with posix_fallocate where available so the
+    filesystem can allocate contiguous extents.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        if hasattr(os, 'posix_fallocate') and data:
+            try:
+                os.posix_fallocate(fd, 0, len(data))
+            except OSError:
+                pass  # Not supported by this filesystem; just write
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+class _DatasetWriter:
+    """
+    Background writer threads of a DatasetBuilder. Kept apart from the builder so the
+    threads don't keep it alive and its finalizer can still close them.
+    """
+    def __init__(self, dataset_dir: str, metadata_path: str, threads: int):
+        self.dataset_dir = dataset_dir
+        self.metadata_path = metadata_path
+        self.images_saved = 0  # Images whose file and metadata line are both written
+        self._lock = threading.Lock()  # Guards the counter and the shard list
+        # Orders submit() against close(), so nothing is queued behind the stop markers.
+        # Never taken by the writer threads, so a submit() blocked on a full queue can't stall them.
+        self._submit_lock = threading.Lock()
+        # Each writer thread appends metadata to its own metadata.part-<pid>-<thread id>.jsonl through
+        # a raw O_APPEND fd; close() concatenates the parts into metadata.jsonl
+        self._local = threading.local()
+        self._shards: List[Tuple[str, int]] = []
+        self._closed = False
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._threads = [
+            threading.Thread(target=self._run, name=f"DatasetBuilderWriter-{i}", daemon=True)
+            for i in range(threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, filepath: str, image_bytes: bytes, metadata: Dict[str, Any]) -> "Future[str]":
+        """
+        Queues an image and its metadata line; the Future resolves once both are written.
+        Raises RuntimeError once the writer has been closed.
+        """
+        saved: "Future[str]" = Future()
+        with self._submit_lock:
+            if self._closed:
+                raise RuntimeError("Dataset writer is closed; no more images can be added.")
+            self._queue.put((filepath, image_bytes, metadata, saved))
+        return saved
+
+    def _run(self):
+        """
+        Background thread: writes queued images and their metadata until it receives None.
+        Everything already queued is handled in one pass, and the metadata lines of that
+        pass are appended to this thread's shard with a single writev().
+        """
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            written = []  # (future, filepath) of images whose metadata line is pending
+            for item in batch:
+                if item is None:
+                    break
+                filepath, image_bytes, metadata, saved = item
+                if not saved.set_running_or_notify_cancel():
+                    continue  # Cancelled by the caller before it was written
+                try:
+                    line = _json_line(metadata)
+                    # Save image
+                    _write_file(filepath, image_bytes)
+                    lines.append(line)
+                    written.append((saved, filepath))
+                except IOError as e:
+                    print(f"Error saving image {metadata['filename']}: {e}")
+                    saved.set_exception(e)
+                except Exception as e:
+                    print(f"Unexpected error while adding image {metadata['filename']}: {e}")
+                    saved.set_exception(e)
+
+            # Write metadata lines; an image only counts as saved once its line is on disk
+            if lines:
+                try:
+                    _write_all(self._shard_fd(), lines)
+                except IOError as e:
+                    print(f"Error appending metadata to {self.metadata_path}: {e}")
+                    for saved, _ in written:
+                        saved.set_exception(e)
+                else:
+                    with self._lock:
+                        self.images_saved += len(written)
+                    for saved, filepath in written:
+                        saved.set_result(filepath)
+
+            if batch[-1] is None:
+                return
+
+    def _shard_fd(self) -> int:
+        """Returns the calling writer thread's metadata shard fd, opening it on first use."""
+        fd = getattr(self._local, 'fd', None)
+        if fd is None:
+            # The pid keeps shards apart when two runs share a dataset directory
+            path = os.path.join(self.dataset_dir,
+                                f"{SHARD_PREFIX}{os.getpid()}-{threading.get_ident()}.jsonl")
+            # No O_TRUNC: a leftover shard with the same name still holds unmerged lines
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+            self._local.fd = fd
+            with self._lock:
+                self._shards.append((path, fd))
+        return fd
+
+    def _leftover_shards(self) -> List[str]:
+        """
+        Shards in the dataset directory written by processes that are gone, e.g. a run
+        that was killed before it could merge them. Shards of live processes (another
+        run sharing this directory) are left alone.
+        """
+        leftovers = []
+        with os.scandir(self.dataset_dir) as it:
+            for entry in it:
+                if not (entry.name.startswith(SHARD_PREFIX) and entry.name.endswith(".jsonl")):
+                    continue
+                pid = entry.name[len(SHARD_PREFIX):-len(".jsonl")].split("-", 1)[0]
+                if pid.isdigit() and int(pid) != os.getpid() and not _process_alive(int(pid)):
+                    leftovers.append(entry.path)
+        return leftovers
+
+    def _merge_shards(self):
+        """
+        Concatenates this writer's metadata shards onto metadata.jsonl and removes them,
+        together with any shards left behind by processes that no longer exist.
+        """
+        for _, shard_fd in self._shards:
+            os.close(shard_fd)
+        shard_paths = sorted(path for path, _ in self._shards) + sorted(self._leftover_shards())
+        self._shards = []
+        if not shard_paths:
+            return
+        # Not O_APPEND: sendfile() refuses to write to append-mode fds. Instead the file is
+        # locked while seeking to its end and appending, so concurrent merges can't overlap.
+        fd = os.open(self.metadata_path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)  # Released when fd is closed
+            os.lseek(fd, 0, os.SEEK_END)
+            for path in shard_paths:
+                _append_file(fd, path)
+                os.remove(path)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """
+        Waits for queued images to be written, then merges the metadata shards into
+        metadata.jsonl. Safe to call more than once.
+        """
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)  # One stop marker per writer
+        for thread in self._threads:
+            thread.join()
+        self._merge_shards()
+
+
 class DatasetBuilder:
     """
     Handles the creation of dataset files and metadata, working with DatasetManager
@@ -25,9 +311,18 @@ class DatasetBuilder:
         # Initialize dataset directory structure using manager
         self.dataset_dir, self.images_dir = self.manager.init_dataset(dataset_name)
         self.metadata_path = self.manager.create_metadata_file(self.dataset_dir)
+        # images_dir sits directly under dataset_dir, so relative paths are just "<this>/<filename>"
+        self._images_rel = os.path.basename(self.images_dir)
         
         self.image_count = 0
-        self._file_lock = threading.Lock()  # Lock for thread-safe file writing
+        self._count_lock = threading.Lock()  # Lock for the image counter when saving from several threads
+        # Images and their metadata are written by background threads so callers can go
+        # straight back to the next API request
+        self._writer = _DatasetWriter(self.dataset_dir, self.metadata_path, WRITER_THREADS)
+        # The writer threads only reference the _DatasetWriter, so the builder can still be
+        # collected; queued writes are then flushed and the metadata shards merged, also at
+        # interpreter exit if finalize_dataset() is never reached
+        self._finalizer = weakref.finalize(self, self._writer.close)
         print(f"Dataset initialized at: {self.dataset_dir}")
 
     def _generate_filename(self, image_bytes: bytes, metadata: Dict[str, Any]) -> str:
@@ -42,20 +337,30 @@ class DatasetBuilder:
         Returns:
             A unique filename string (e.g., "img_s123_cfg7_prompt_abc123def.png").
         """
-        self.image_count += 1
-        base_name = f"image_{self.image_count:05d}"  # Default sequential name
+        with self._count_lock:
+            self.image_count += 1
+            base_name = f"image_{self.image_count:05d}"  # Default sequential name
 
         try:
             # Extract key parameters safely using .get()
-            seed = metadata.get('request_parameters', {}).get('seed', 'unknown')
-            cfg = metadata.get('request_parameters', {}).get('cfg_scale', 'unknown')
+            request_params = metadata.get('request_parameters') or _EMPTY_DICT
+            seed = request_params.get('seed', 'unknown')
+            cfg = request_params.get('cfg_scale', 'unknown')
             # Use first few words of prompt (cleaned)
-            prompt_str = str(metadata.get('request_parameters', {}).get('prompt', ''))
-            prompt_prefix = "_".join(prompt_str.split()[:3]).lower()
-            prompt_prefix = ''.join(c for c in prompt_prefix if c.isalnum() or c == '_')
+            prompt_str = request_params.get('prompt', '')
+            if not isinstance(prompt_str, str):
+                prompt_str = str(prompt_str)
+            prompt_prefix = "_".join(prompt_str.split(None, 3)[:3]).lower()
+            prompt_prefix = _CLEAN_RE.sub('', prompt_prefix)
 
-            # Add a short hash of image bytes for uniqueness
-            img_hash = hashlib.sha1(image_bytes).hexdigest()[:8]
+            # Add a short hash of image bytes for uniqueness. Seed, CFG and prompt already
+            # nearly identify the image, so hashing both ends (plus the length) is enough.
+            if len(image_bytes) <= 2 * HASH_SAMPLE_BYTES:
+                img_hash = _short_hash(image_bytes)
+            else:
+                img_hash = _short_hash(len(image_bytes).to_bytes(8, 'little'),
+                                       image_bytes[:HASH_SAMPLE_BYTES],
+                                       image_bytes[-HASH_SAMPLE_BYTES:])
 
             # Combine parts, ensuring they are strings
             parts = [
@@ -72,53 +377,43 @@ class DatasetBuilder:
 
         return f"{base_name}.png"
 
-    def add_image(self, image_bytes: bytes, metadata: Dict[str, Any]):
+    def add_image(self, image_bytes: bytes, metadata: Dict[str, Any]) -> Optional["Future[str]"]:
         """
-        Saves an image to the dataset and appends its metadata.
+        Queues an image and its metadata for writing to the dataset.
+        The files are written by the background writer threads.
 
         Args:
             image_bytes: The image data in bytes.
             metadata: The metadata dictionary for this image.
                      Should include A1111 'info' and 'request_parameters'.
+
+        Returns:
+            A Future that resolves to the saved image's path once both the image and
+            its metadata line are written, or raises the error that stopped them.
+            None if the image was rejected.
+
+        Raises:
+            RuntimeError: If the builder has already been closed.
         """
         if not image_bytes:
             print("Warning: Received empty image bytes. Skipping.")
-            return
+            return None
 
         filename = self._generate_filename(image_bytes, metadata)
         filepath = os.path.join(self.images_dir, filename)
 
-        try:
-            # Save image
-            with open(filepath, "wb") as f:
-                f.write(image_bytes)
-
-            # Update metadata with file information
-            metadata['filename'] = filename
-            metadata['filepath'] = os.path.relpath(filepath, self.dataset_dir)
+        # Update metadata with file information
+        metadata['filename'] = filename
+        metadata['filepath'] = f"{self._images_rel}/{filename}"
 
-            # Write metadata line
-            self._append_metadata(metadata)
+        return self._writer.submit(filepath, image_bytes, metadata)
 
-        except IOError as e:
-            print(f"Error saving image {filename} or its metadata: {e}")
-        except Exception as e:
-            print(f"Unexpected error while adding image {filename}: {e}")
-
-    def _append_metadata(self, metadata: Dict[str, Any]):
+    def close(self):
         """
-        Appends a single metadata record to the JSON Lines file.
-        Uses file lock for thread safety.
+        Waits for queued images to be written, then merges the metadata shards into
+        metadata.jsonl. Safe to call more than once.
         """
-        try:
-            with self._file_lock:
-                with open(self.metadata_path, 'a', encoding='utf-8') as f:
-                    json_record = json.dumps(metadata, ensure_ascii=False)
-                    f.write(json_record + '\n')
-        except IOError as e:
-            print(f"Error appending metadata to {self.metadata_path}: {e}")
-        except Exception as e:
-            print(f"Unexpected error while appending metadata: {e}")
+        self._finalizer()
 
     def finalize_dataset(self) -> Optional[str]:
         """
@@ -127,14 +422,25 @@ class DatasetBuilder:
         Returns:
             The path to the metadata file if images were added, otherwise None.
         """
+        self.close()
+
         if self.image_count == 0:
             print("No images were added to the dataset.")
             # Consider archiving or cleaning up empty dataset
             return None
 
+        # Record the totals so listings don't have to rescan the images directory
+        try:
+            self.manager.write_dataset_summary(
+                self.dataset_dir,
+                image_count=self._writer.images_saved
+            )
+        except (IOError, OSError) as e:
+            print(f"Warning: Could not write dataset summary: {e}")
+
         # Get dataset info using manager
         try:
-            info = self.manager.get_dataset_info(self.dataset_name)
+            info = self.manager.get_dataset_summary(self.dataset_name)
             print(f"Dataset generation finished:")
             print(f"- Total images: {info['image_count']}")
             print(f"- Total size: {info['total_size']} bytes")
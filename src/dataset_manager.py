@@ -3,13 +3,39 @@ Dataset Manager: Handles organization and management of generated datasets.
 """
 
 import os
+import itertools
 import shutil
+import zipfile
 import json
 import yaml
 from datetime import datetime
 from pathlib import Path
 import logging
 
+# Summary written by DatasetBuilder when a dataset is finalized
+INFO_FILENAME = "info.json"
+
+# Already-compressed files that are stored as-is in exported zips
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".zip"}
+
+
+def _format_timestamp(ts):
+    """Formats a datetime as "YYYY-MM-DD HH:MM:SS"; f-strings avoid strftime's locale handling."""
+    return f"{ts.year:04}-{ts.month:02}-{ts.day:02} {ts.hour:02}:{ts.minute:02}:{ts.second:02}"
+
+
+def _name_timestamp(ts):
+    """Formats a datetime as the "YYYYMMDD_HHMMSS" suffix used in dataset directory names."""
+    return f"{ts.year:04}{ts.month:02}{ts.day:02}_{ts.hour:02}{ts.minute:02}{ts.second:02}"
+
+
+def _mtime_ns(path):
+    """Modification time of path in nanoseconds, or None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
 class DatasetManager:
     def __init__(self, base_dir="output_datasets"):
         """
@@ -20,6 +46,8 @@ class DatasetManager:
         self.base_dir = Path(base_dir)
         self.archive_dir = self.base_dir / "archive"
         self.tmp_dir = self.base_dir / "tmp"
+        # (name, path) -> (mtimes, summary); entries go stale as soon as any mtime changes
+        self._summary_cache = {}
         
         # Create necessary directories
         self.base_dir.mkdir(exist_ok=True)
@@ -40,7 +68,7 @@ class DatasetManager:
             tuple: (dataset_dir, images_dir) paths
         """
         # Add timestamp to prevent conflicts
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = _name_timestamp(datetime.now())
         dataset_dir = self.base_dir / f"{dataset_name}_{timestamp}"
         images_dir = dataset_dir / "images"
         
@@ -68,6 +96,42 @@ class DatasetManager:
             metadata_path.touch()
         return str(metadata_path)
 
+    def write_dataset_summary(self, dataset_dir, image_count):
+        """
+        Write the info.json summary used by list_datasets and get_dataset_info
+        instead of scanning the dataset directory. The recorded total_size covers
+        every file in the dataset except info.json itself, matching the size
+        reported for datasets without a summary.
+        Args:
+            dataset_dir (str): Dataset directory path
+            image_count (int): Number of images in the dataset
+        """
+        info_path = Path(dataset_dir) / INFO_FILENAME
+        total_size = self._dir_size(info_path.parent)
+        if info_path.exists():
+            total_size -= info_path.stat().st_size  # An earlier summary is not part of the data
+        summary = {
+            "image_count": image_count,
+            "total_size": total_size,
+            "created": _format_timestamp(datetime.now())
+        }
+        with open(Path(dataset_dir) / INFO_FILENAME, "w", encoding="utf-8") as f:
+            json.dump(summary, f)
+
+    def _read_dataset_summary(self, dataset_dir):
+        """
+        Read a dataset's info.json summary.
+        Args:
+            dataset_dir (Path): Dataset directory path
+        Returns:
+            dict: The summary, or None if it is missing or unreadable
+        """
+        try:
+            with open(dataset_dir / INFO_FILENAME, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
     def archive_dataset(self, dataset_name):
         """
         Move a dataset to the archive directory.
@@ -105,11 +169,13 @@ class DatasetManager:
         if not output_path:
             output_path = str(self.base_dir / f"{dataset_name}.zip")
         
-        shutil.make_archive(
-            output_path.replace('.zip', ''),  # Remove .zip as make_archive adds it
-            'zip',
-            str(dataset_dir)
-        )
+        # PNGs are already deflated, so they are stored; only text files (metadata, config) are compressed
+        with zipfile.ZipFile(output_path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for f in sorted(dataset_dir.rglob("*")):
+                if f.is_file():
+                    compression = (zipfile.ZIP_STORED if f.suffix.lower() in STORED_EXTENSIONS
+                                   else zipfile.ZIP_DEFLATED)
+                    zf.write(f, f.relative_to(dataset_dir).as_posix(), compress_type=compression)
         
         self.logger.info(f"Exported dataset to: {output_path}")
         return output_path
@@ -136,13 +202,12 @@ class DatasetManager:
             shutil.unpack_archive(str(zip_path), str(extract_dir))
             
             # Determine target directory name
+            timestamp = _name_timestamp(datetime.now())
             if new_name:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 target_dir = self.base_dir / f"{new_name}_{timestamp}"
             else:
                 # Use original name but add new timestamp
                 original_name = next(extract_dir.iterdir()).name.split('_')[0]
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 target_dir = self.base_dir / f"{original_name}_{timestamp}"
             
             # Move extracted contents to target directory
@@ -157,6 +222,69 @@ class DatasetManager:
             if extract_dir.exists():
                 shutil.rmtree(str(extract_dir))
 
+    def _count_images(self, dataset_dir):
+        """
+        Number of images in a dataset, from info.json if present, else by scanning.
+        Args:
+            dataset_dir (Path): Dataset directory path
+        Returns:
+            int: Image count
+        """
+        summary = self._read_dataset_summary(dataset_dir)
+        if summary is not None and "image_count" in summary:
+            return summary["image_count"]
+        return self._count_pngs(dataset_dir / "images")
+
+    @staticmethod
+    def _count_pngs(images_dir):
+        """
+        Count the PNG files in a directory without building Path objects.
+        Args:
+            images_dir (Path): Directory to scan
+        Returns:
+            int: Number of .png files, 0 if the directory does not exist
+        """
+        try:
+            with os.scandir(images_dir) as it:
+                return sum(1 for entry in it if entry.name.endswith(".png"))
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _dir_size(path):
+        """
+        Total size of the files under a directory, walked iteratively with os.scandir.
+        Args:
+            path (Path): Directory to measure
+        Returns:
+            int: Size in bytes
+        """
+        total = 0
+        stack = [path]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        total += entry.stat().st_size
+        return total
+
+    @staticmethod
+    def _scan_dataset_dirs(parent):
+        """
+        Yield dataset directories (names of the form <name>_<timestamp>) under parent.
+        os.scandir reuses the directory entry type, so no extra stat per entry.
+        Args:
+            parent (Path): Directory to scan
+        Yields:
+            Path: Dataset directory paths
+        """
+        with os.scandir(parent) as it:
+            for entry in it:
+                if "_" in entry.name and entry.is_dir(follow_symlinks=False):
+                    yield parent / entry.name
+
     def list_datasets(self, include_archived=False):
         """
         List all available datasets.
@@ -168,8 +296,8 @@ class DatasetManager:
         datasets = {}
         
         # List active datasets
-        for dataset_dir in self.base_dir.glob("*_*/"):
-            if dataset_dir.is_dir() and dataset_dir not in [self.archive_dir, self.tmp_dir]:
+        for dataset_dir in self._scan_dataset_dirs(self.base_dir):
+            if dataset_dir not in [self.archive_dir, self.tmp_dir]:
                 name = dataset_dir.name
                 metadata_file = dataset_dir / "metadata.jsonl"
                 config_file = dataset_dir / "config.yaml"
@@ -179,36 +307,34 @@ class DatasetManager:
                     "status": "active",
                     "has_metadata": metadata_file.exists(),
                     "has_config": config_file.exists(),
-                    "image_count": len(list((dataset_dir / "images").glob("*.png")))
+                    "image_count": self._count_images(dataset_dir)
                 }
         
         # List archived datasets if requested
         if include_archived:
-            for dataset_dir in self.archive_dir.glob("*_*/"):
-                if dataset_dir.is_dir():
-                    name = dataset_dir.name
-                    metadata_file = dataset_dir / "metadata.jsonl"
-                    config_file = dataset_dir / "config.yaml"
-                    
-                    datasets[name] = {
-                        "path": str(dataset_dir),
-                        "status": "archived",
-                        "has_metadata": metadata_file.exists(),
-                        "has_config": config_file.exists(),
-                        "image_count": len(list((dataset_dir / "images").glob("*.png")))
-                    }
+            for dataset_dir in self._scan_dataset_dirs(self.archive_dir):
+                name = dataset_dir.name
+                metadata_file = dataset_dir / "metadata.jsonl"
+                config_file = dataset_dir / "config.yaml"
+                
+                datasets[name] = {
+                    "path": str(dataset_dir),
+                    "status": "archived",
+                    "has_metadata": metadata_file.exists(),
+                    "has_config": config_file.exists(),
+                    "image_count": self._count_images(dataset_dir)
+                }
         
         return datasets
 
-    def get_dataset_info(self, dataset_name):
+    def _find_dataset_dir(self, dataset_name):
         """
-        Get detailed information about a specific dataset.
+        Locate a dataset, looking in active datasets first, then archived.
         Args:
             dataset_name (str): Name of the dataset
         Returns:
-            dict: Dataset information
+            tuple: (dataset_dir, status)
         """
-        # Look in active datasets first, then archived
         dataset_dir = next(self.base_dir.glob(f"{dataset_name}_*"), None)
         status = "active"
         
@@ -218,35 +344,101 @@ class DatasetManager:
         
         if not dataset_dir:
             raise FileNotFoundError(f"Dataset not found: {dataset_name}")
+        return dataset_dir, status
+
+    def get_dataset_summary(self, dataset_name):
+        """
+        Get the cheap facts about a dataset: location, timestamps, image count and size.
+        Does not open the metadata or config files. Results are memoized until the
+        dataset directory, its images directory, metadata or info.json change.
+        Args:
+            dataset_name (str): Name of the dataset
+        Returns:
+            dict: Dataset summary
+        """
+        dataset_dir, status = self._find_dataset_dir(dataset_name)
         
         metadata_file = dataset_dir / "metadata.jsonl"
         config_file = dataset_dir / "config.yaml"
         images_dir = dataset_dir / "images"
         
-        info = {
+        dir_stat = dataset_dir.stat()
+        cache_key = (dataset_name, str(dataset_dir))
+        mtimes = (dir_stat.st_mtime_ns, _mtime_ns(images_dir), _mtime_ns(metadata_file),
+                  _mtime_ns(dataset_dir / INFO_FILENAME))
+        cached = self._summary_cache.get(cache_key)
+        if cached is not None and cached[0] == mtimes:
+            return dict(cached[1])
+
+        # Prefer the summary written at finalize time over rescanning every file
+        summary = self._read_dataset_summary(dataset_dir) or {}
+
+        result = {
             "name": dataset_name,
             "path": str(dataset_dir),
             "status": status,
-            "created": datetime.fromtimestamp(dataset_dir.stat().st_ctime).strftime("%Y-%m-%d %H:%M:%S"),
-            "modified": datetime.fromtimestamp(dataset_dir.stat().st_mtime).strftime("%Y-%m-%d %H:%M:%S"),
+            "created": summary.get("created") or _format_timestamp(datetime.fromtimestamp(dir_stat.st_ctime)),
+            "modified": _format_timestamp(datetime.fromtimestamp(dir_stat.st_mtime)),
             "has_metadata": metadata_file.exists(),
             "has_config": config_file.exists(),
-            "image_count": len(list(images_dir.glob("*.png"))) if images_dir.exists() else 0,
-            "total_size": sum(f.stat().st_size for f in dataset_dir.rglob("*") if f.is_file()),
-            "config": None,
-            "metadata_sample": None
+            "image_count": summary["image_count"] if "image_count" in summary
+                           else self._count_pngs(images_dir),
+            "total_size": summary["total_size"] if "total_size" in summary
+                          else self._dir_size(dataset_dir)
         }
+        self._summary_cache[cache_key] = (mtimes, result)
+        return dict(result)
+
+    def get_dataset_sample(self, dataset_name, count=3):
+        """
+        Read the first few metadata records of a dataset.
+        Args:
+            dataset_name (str): Name of the dataset
+            count (int): Maximum number of records to return
+        Returns:
+            list: Metadata records, empty if the dataset has no metadata file
+        """
+        dataset_dir, _ = self._find_dataset_dir(dataset_name)
+        return self._read_metadata_sample(dataset_dir / "metadata.jsonl", count)
+
+    @staticmethod
+    def _read_metadata_sample(metadata_file, count):
+        """
+        Parse up to count records from the start of a metadata file.
+        Args:
+            metadata_file (Path): Path to metadata.jsonl
+            count (int): Maximum number of lines to read
+        Returns:
+            list: Metadata records, empty if the file does not exist
+        """
+        try:
+            with open(metadata_file, "r", encoding="utf-8") as f:
+                return [json.loads(line) for line in itertools.islice(f, count) if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def get_dataset_info(self, dataset_name):
+        """
+        Get detailed information about a specific dataset: the summary plus its
+        config and a sample of its metadata.
+        Args:
+            dataset_name (str): Name of the dataset
+        Returns:
+            dict: Dataset information
+        """
+        info = self.get_dataset_summary(dataset_name)
+        dataset_dir = Path(info["path"])
+        info["config"] = None
+        info["metadata_sample"] = None
         
         # Load config if available
-        if config_file.exists():
-            with open(config_file, "r", encoding="utf-8") as f:
+        if info["has_config"]:
+            with open(dataset_dir / "config.yaml", "r", encoding="utf-8") as f:
                 info["config"] = yaml.safe_load(f)
         
         # Load sample of metadata if available
-        if metadata_file.exists():
-            with open(metadata_file, "r", encoding="utf-8") as f:
-                first_lines = [next(f) for _ in range(3)]
-                info["metadata_sample"] = [json.loads(line) for line in first_lines if line.strip()]
+        if info["has_metadata"]:
+            info["metadata_sample"] = self._read_metadata_sample(dataset_dir / "metadata.jsonl", 3)
         
         return info
 
@@ -1,12 +1,37 @@
 # Module orchestrating the image generation process.
 import itertools
+import math
 import os
-from typing import Dict, Any, List, Iterator, Tuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Any, List, Iterator, Tuple, Callable
 
 from .config_loader import load_config
 from .a1111_client import A1111Client
 from .dataset_builder import DatasetBuilder
 
+# Requests kept in flight when the config does not set 'concurrency'
+DEFAULT_CONCURRENCY = 4
+
+def _compile_combination_builder(base_params: Dict[str, Any], variation_keys: List[str]) -> Callable[..., Dict[str, Any]]:
+    """
+    Generates and compiles a function that builds one parameter set from the variation
+    values, e.g. `def _build(_v0, _v1): return {**_base, 'seed': _v0, 'prompt': _v1}`.
+    A dict display with the keys written out is cheaper than copy() + update() per combination.
+
+    Args:
+        base_params: Dictionary of base parameters.
+        variation_keys: Parameter names, in the order their values will be passed.
+
+    Returns:
+        The compiled builder function.
+    """
+    arg_names = [f"_v{i}" for i in range(len(variation_keys))]
+    entries = ", ".join(f"{key!r}: {arg}" for key, arg in zip(variation_keys, arg_names))
+    source = f"def _build({', '.join(arg_names)}):\n    return {{**_base, {entries}}}\n"
+    namespace = {'_base': base_params}
+    exec(compile(source, "<parameter combinations>", "exec"), namespace)
+    return namespace['_build']
+
 def generate_parameter_combinations(base_params: Dict[str, Any], variations: Dict[str, List[Any]]) -> Iterator[Dict[str, Any]]:
     """
     Generates all combinations of parameters based on the variations.
@@ -28,12 +53,18 @@ def generate_parameter_combinations(base_params: Dict[str, Any], variations: Dic
     variation_values = [variations[key] for key in variation_keys]
 
     # Create all combinations of the variation values
+    if all(isinstance(key, str) for key in variation_keys):
+        # Keys can be written into generated code, so build each set with a specialized function
+        build = _compile_combination_builder(base_params, variation_keys)
+        yield from itertools.starmap(build, itertools.product(*variation_values))
+        return
+
     for value_combination in itertools.product(*variation_values):
-        # Create a new parameter set for this combination
-        current_params = base_params.copy()
-        variation_dict = dict(zip(variation_keys, value_combination))
-        current_params.update(variation_dict) # Override base params with variation values
-        yield current_params
+        # Copy the base params and lay the variation values over them, without
+        # building an intermediate dict for the variations
+        params = base_params.copy()
+        params.update(zip(variation_keys, value_combination))
+        yield params
 
 
 def run_generation(config_path: str):
@@ -50,8 +81,12 @@ def run_generation(config_path: str):
         print(f"Error loading configuration: {e}")
         return
 
+    # Requests are independent, so several are kept in flight against the API
+    concurrency = config.get('concurrency', DEFAULT_CONCURRENCY)
+
     try:
-        client = A1111Client(config['api_url'])
+        # One pooled keep-alive connection per request thread
+        client = A1111Client(config['api_url'], pool_size=concurrency)
     except (ConnectionError, TimeoutError, RuntimeError) as e:
         print(f"Error initializing A1111 client: {e}")
         return
@@ -62,9 +97,7 @@ def run_generation(config_path: str):
     )
 
     print("\nStarting image generation process...")
-    total_combinations = 1
-    for values in config['parameter_variations'].values():
-        total_combinations *= len(values) if values else 1
+    total_combinations = math.prod(len(values) or 1 for values in config['parameter_variations'].values())
     print(f"Total parameter combinations to generate: {total_combinations}")
 
     generated_count = 0
@@ -79,7 +112,8 @@ def run_generation(config_path: str):
         config['parameter_variations']
     )
 
-    for i, params in enumerate(param_combinations):
+    def generate_one(i: int, params: Dict[str, Any]) -> bool:
+        """Generates and saves the image for one combination. Returns True on success."""
         print(f"\n--- Generating image {i+1}/{total_combinations} ---")
         print(f"Parameters: {params}")
 
@@ -95,35 +129,72 @@ def run_generation(config_path: str):
                 # Add the used parameters to the metadata we save
                 # The 'info' dict from A1111 might already contain most of this,
                 # but we explicitly add the combined params for clarity.
-                metadata = generation_info.copy() # Start with info from A1111
+                # The client returns a fresh info dict per image, so it is extended in place
+                metadata = generation_info # Start with info from A1111
                 metadata['request_parameters'] = params # Add the parameters we sent
 
-                builder.add_image(image_bytes, metadata)
-                generated_count += 1
+                saved = builder.add_image(image_bytes, metadata)
+                if saved is None:
+                    print(f"Image {i+1} could not be saved.")
+                    return False
+                # The builder writes in the background; wait until the image and its metadata are on disk
+                try:
+                    saved.result()
+                except Exception as e:
+                    print(f"Image {i+1} could not be saved: {e}")
+                    return False
                 print(f"Image {i+1} added to dataset.")
-            else:
-                failed_count += 1
-                print(f"Image {i+1} generation failed.")
+                return True
+
+            print(f"Image {i+1} generation failed.")
+            return False
 
         except Exception as e:
-            failed_count += 1
             print(f"An unexpected error occurred during generation for parameters {params}: {e}")
-            # Decide if you want to stop or continue on error
-            # continue
+            return False
 
-    print("\n--- Generation Complete ---")
-    print(f"Successfully generated: {generated_count}")
-    print(f"Failed generations: {failed_count}")
-
-    if generated_count > 0:
+    try:
+        # DatasetBuilder does the disk writes on its own threads, and every image gets its own file.
+        print(f"Sending up to {concurrency} requests concurrently.")
+        executor = ThreadPoolExecutor(max_workers=concurrency)
         try:
-            metadata_path = builder.finalize_dataset()
-            print(f"Dataset saved to: {builder.dataset_dir}")
-            print(f"Metadata saved to: {metadata_path}")
-        except Exception as e:
-            print(f"Error finalizing dataset: {e}")
-    else:
-        print("No images were generated, dataset not finalized.")
+            combinations_iter = enumerate(param_combinations)
+            pending = set()
+            while True:
+                # Keep up to `concurrency` requests in flight, handing out new combinations
+                # as others finish, so the combinations are still consumed lazily
+                for i, params in itertools.islice(combinations_iter, concurrency - len(pending)):
+                    pending.add(executor.submit(generate_one, i, params))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.result():
+                        generated_count += 1
+                    else:
+                        failed_count += 1
+        except BaseException:
+            # E.g. Ctrl-C: drop queued work instead of running every remaining request first
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown(wait=True)
+
+        print("\n--- Generation Complete ---")
+        print(f"Successfully generated: {generated_count}")
+        print(f"Failed generations: {failed_count}")
+
+        if generated_count > 0:
+            try:
+                metadata_path = builder.finalize_dataset()
+                print(f"Dataset saved to: {builder.dataset_dir}")
+                print(f"Metadata saved to: {metadata_path}")
+            except Exception as e:
+                print(f"Error finalizing dataset: {e}")
+        else:
+            print("No images were generated, dataset not finalized.")
+    finally:
+        # Flushes queued writes and merges the metadata even if generation is interrupted
+        builder.close()
 
 if __name__ == '__main__':
     # Example of how to run this module directly (for testing)
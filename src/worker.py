@@ -0,0 +1,199 @@
+"""Background generation worker used by the Streamlit web interface.
+
+The worker runs in a separate process (see app.py), so it lives in an importable
+module that the 'spawn' start method can pickle by reference.
+"""
+import asyncio
+import io
+import itertools
+import math
+import os
+import shutil
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from PIL import Image
+
+from .a1111_client import A1111Client
+from .dataset_builder import DatasetBuilder
+from .generator import generate_parameter_combinations
+
+# Number of parameter combinations handed to the A1111 client per batched request
+BATCH_SIZE = 4
+# Longest side of the preview thumbnails shown in the web app
+PREVIEW_SIZE = 256
+# Threads that render preview thumbnails while the next requests are in flight
+PREVIEW_WORKERS = 2
+# Upper bound on generated images waiting to be written; below DatasetBuilder's
+# write queue size, so handing an image to the builder never blocks the event loop
+MAX_PENDING_SAVES = 8
+
+
+def _write_preview(image_bytes, preview_path):
+    """Writes a downscaled PNG copy of an image for the web app's preview grid."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), Image.LANCZOS)
+        img.save(preview_path, format="PNG")
+
+
+async def generation_worker(api_url_w, dataset_name_w, output_base_dir_w,
+                            base_params_w, variations_w, queue, previous_preview_dir_w=None):
+    """
+    Background worker for image generation process.
+    previous_preview_dir_w is the preview directory of the run this one replaces in the
+    same app session; its thumbnails are no longer shown, so it is removed.
+    """
+    builder = None
+    try:
+        queue.put({"log": "Worker process started..."})
+
+        try:
+            client = A1111Client(api_url_w)
+            builder = DatasetBuilder(dataset_name_w, output_base_dir_w)
+            # Preview thumbnails go to the manager's tmp dir so they don't end up in exports.
+            # Only this session's previous run is cleaned up; other sessions may be showing theirs.
+            if previous_preview_dir_w:
+                shutil.rmtree(previous_preview_dir_w, ignore_errors=True)
+            preview_dir = os.path.join(builder.manager.tmp_dir, "previews",
+                                       os.path.basename(builder.dataset_dir))
+            os.makedirs(preview_dir, exist_ok=True)
+            queue.put({"log": "Backend initialized.", "preview_dir": preview_dir})
+        except Exception as e:
+            raise RuntimeError(f"Failed to initialize backend: {e}")
+
+        # Combinations are produced lazily; the count comes straight from the variation lists
+        param_combinations = generate_parameter_combinations(base_params_w, variations_w)
+        total_combinations = math.prod(len(values) for values in variations_w.values())
+        queue.put({"total": total_combinations})
+        queue.put({"status": f"Streaming {total_combinations} combinations..."})
+
+        generated_count = 0
+        failed_count = 0
+        completed_count = 0
+        # Number of batched requests allowed in flight against the A1111 server
+        concurrency = max(1, int(os.getenv("A1111_CONCURRENCY", 4)))
+
+        async def save_image(i, image_bytes, metadata):
+            """Hands one image to the builder, renders its preview and reports it once it is on disk."""
+            try:
+                saved = builder.add_image(image_bytes, metadata)
+                if saved is None:
+                    queue.put({"log": f"ERROR: Image {i+1} could not be saved."})
+                    return False
+                caption = f"Image {i+1}: {metadata.get('filename', 'N/A')}"
+                preview_path = os.path.join(preview_dir, metadata['filename'])
+                try:
+                    await loop.run_in_executor(preview_executor, _write_preview, image_bytes, preview_path)
+                except Exception as e:
+                    preview_path = None
+                    queue.put({"log": f"WARNING: No preview for image {i+1}: {e}"})
+                try:
+                    filepath = await asyncio.wrap_future(saved)
+                except Exception as e:
+                    queue.put({"log": f"ERROR: Image {i+1} could not be saved: {e}"})
+                    return False
+                queue.put({
+                    "log": f"SUCCESS: Image {i+1} saved.",
+                    "image": (caption, preview_path or filepath) # Full image if there is no preview
+                })
+                return True
+            except Exception as e:
+                error_trace = traceback.format_exc()
+                queue.put({"log": f"CRITICAL: Error on image {i+1}: {e}\n{error_trace}"})
+                return False
+
+        # The builder writes images on its own threads and thumbnails are rendered on a small
+        # pool, so both overlap with the next requests; at most MAX_PENDING_SAVES decoded
+        # images wait to be written at any time.
+        loop = asyncio.get_running_loop()
+        preview_executor = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS)
+        pending_saves = set()
+
+        async def wait_for_saves(return_when):
+            nonlocal pending_saves, generated_count, failed_count
+            saved, pending_saves = await asyncio.wait(pending_saves, return_when=return_when)
+            for future in saved:
+                if future.result():
+                    generated_count += 1
+                else:
+                    failed_count += 1
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                async def run_batch(batch):
+                    first, last = batch[0][0] + 1, batch[-1][0] + 1
+                    current_job_text = f"Generating images {first}-{last}/{total_combinations}..."
+                    queue.put({
+                        "status": current_job_text,
+                        "log": f"INFO: {current_job_text}\nDEBUG: {[params for _, params in batch]}"
+                    })
+                    try:
+                        results = await client.agenerate_images_batch([params for _, params in batch], session)
+                        return batch, results, None
+                    except Exception as e:
+                        return batch, None, f"CRITICAL: Error on images {first}-{last}: {e}\n{traceback.format_exc()}"
+
+                combinations_iter = enumerate(param_combinations)
+                pending = set()
+                while True:
+                    # Keep up to `concurrency` batches in flight, handing out new ones as others finish
+                    while len(pending) < concurrency:
+                        batch = list(itertools.islice(combinations_iter, BATCH_SIZE))
+                        if not batch:
+                            break
+                        pending.add(asyncio.ensure_future(run_batch(batch)))
+                    if not pending:
+                        if completed_count == 0:
+                            raise ValueError("No parameter combinations generated. Check variations.")
+                        break
+
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        batch, results, error = task.result()
+                        completed_count += len(batch)
+                        queue.put({"progress": completed_count / total_combinations})
+
+                        if results is None:
+                            failed_count += len(batch)
+                            queue.put({"log": error})
+                            continue
+
+                        for (i, params), (image_bytes, generation_info) in zip(batch, results):
+                            if not (image_bytes and generation_info):
+                                failed_count += 1
+                                queue.put({"log": f"ERROR: Image {i+1} generation failed."})
+                                continue
+
+                            metadata = generation_info # Fresh dict per image, no copy needed
+                            metadata['request_parameters'] = params
+                            if len(pending_saves) >= MAX_PENDING_SAVES:
+                                await wait_for_saves(asyncio.FIRST_COMPLETED)
+                            pending_saves.add(asyncio.ensure_future(save_image(i, image_bytes, metadata)))
+
+            # Every image must be on disk before the dataset is finalized
+            if pending_saves:
+                await wait_for_saves(asyncio.ALL_COMPLETED)
+        finally:
+            preview_executor.shutdown(wait=True)
+
+        final_status = f"Finished. Generated: {generated_count}, Failed: {failed_count}."
+        metadata_path = builder.finalize_dataset()
+        if metadata_path:
+            final_status += f"\nDataset saved. Metadata: {metadata_path}"
+
+        queue.put({"status": final_status, "progress": 1.0, "done": True})
+
+    except Exception as e:
+        error_trace = traceback.format_exc()
+        queue.put({"status": f"Worker Error: {e}", "error": str(e), 
+                  "log": error_trace, "done": True})
+    finally:
+        # Flushes queued writes and merges the metadata even if the run failed part way
+        if builder is not None:
+            builder.close()
+
+
+def run_generation_worker(*args):
+    """Process entry point: drives the async generation worker on its own event loop."""
+    asyncio.run(generation_worker(*args))